@@ -1,7 +1,11 @@
-import os, time, uuid, threading, datetime
-from typing import Optional, Dict, Any, List
-from flask import Flask, request, jsonify
-import requests
+import os, re, math, time, uuid, hmac, queue, socket, hashlib, logging, threading, datetime, functools
+from typing import Optional, Dict, Any, List, Callable, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request
+import orjson
+import httpx
+import ciso8601
+from cachetools import TTLCache
 
 # ─────────────────────────────────────────────────────────────
 # ENV (set these in Render → Environment)
@@ -16,8 +20,39 @@ TDV_DEVICE_ID    = os.getenv("TDV_DEVICE_ID", str(uuid.uuid4()))
 TDV_SEC          = os.getenv("TDV_SEC")
 TDV_ACCOUNT_ID   = os.getenv("TDV_ACCOUNT_ID")  # optional; auto-picks first if missing
 TV_SHARED_SECRET = os.getenv("TV_SHARED_SECRET", "")  # optional; header X-TV-Secret or ?secret=
+_SECRET_BYTES    = TV_SHARED_SECRET.encode() if TV_SHARED_SECRET else None
 
 HTTP_TIMEOUT_S   = 15
+HTTP_CONNECT_S   = 3
+HTTP_TIMEOUT     = httpx.Timeout(HTTP_TIMEOUT_S, connect=HTTP_CONNECT_S)
+# No Nagle delay on small JSON POSTs; OS keepalive probes hold idle pooled sockets open
+HTTP_SOCKET_OPTIONS = [
+    (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+]
+
+# Resolved contractIds expire so front-month rolls are picked up without a restart
+CONTRACT_CACHE_SIZE  = 512
+CONTRACT_CACHE_TTL_S = 3600
+
+# Background token refresh fires this long before expiry (inline check uses 60s)
+TOKEN_REFRESH_LEAD_S  = 120
+TOKEN_REFRESH_RETRY_S = 30
+
+# Max position closes sent concurrently by flatten_side
+FLATTEN_MAX_PARALLEL = 8
+
+# Webhook → order queue (webhook answers 202, a worker thread talks to Tradovate)
+ORDER_QUEUE_SIZE      = 1024
+ORDER_MAX_ATTEMPTS    = 3      # per order/place POST; only when it provably never reached Tradovate
+ORDER_RETRY_BACKOFF_S = 0.5
+ORDER_RETRY_AFTER_MAX_S = 5.0  # cap on a 503's Retry-After
+# Dedupe TV retries of alerts that carry an "id" (e.g. the strategy order id); keyed on
+# id + body, so two different signals sharing an id are both placed
+WEBHOOK_DEDUPE_S      = float(os.getenv("WEBHOOK_DEDUPE_S", "60"))
+# Opt-in body-hash dedupe for alerts without an id. Off by default: fixed alert
+# templates make a real repeat signal byte-identical to a retry.
+WEBHOOK_BODY_DEDUPE_S = float(os.getenv("WEBHOOK_BODY_DEDUPE_S", "0"))
 
 # ─────────────────────────────────────────────────────────────
 # RISK GUARDRAILS (tuned for $50k acct / $2k MDD) — EDIT HERE
@@ -55,19 +90,72 @@ MAX_NOTIONAL_PER_ORDER = float(os.getenv("RISK_MAX_NOTIONAL", "20000"))
 # App
 # ─────────────────────────────────────────────────────────────
 app = Flask(__name__)
+# order outcomes are logged at INFO from the queue worker; gunicorn leaves Flask at WARNING
+app.logger.setLevel(logging.INFO)
+
+def _json(r) -> Any:
+    """Decode a Tradovate response body straight from bytes (orjson, no str round-trip)."""
+    return orjson.loads(r.content)
+
+def _jsonify(obj: Any):
+    return app.response_class(orjson.dumps(obj), mimetype="application/json")
 
 # ─────────────────────────────────────────────────────────────
 # Tradovate REST client
 # ─────────────────────────────────────────────────────────────
+_HAS_DIGIT = re.compile(r"\d").search
+
+def _utc_ts(raw: Any) -> Optional[float]:
+    """ISO-8601 string from Tradovate → POSIX timestamp (naive values are UTC); None if unparseable."""
+    try:
+        dt = ciso8601.parse_datetime(raw)   # handles the trailing "Z" natively
+    except (ValueError, TypeError):
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.timestamp()
+
+def _retry_delay(exc: Exception) -> Optional[float]:
+    """Seconds to wait before re-sending, or None if the order may already have been accepted.
+
+    order/place is not idempotent: a 502/504 or read timeout can arrive after Tradovate
+    took the order, so only retry a single POST when it never left (connect/pool
+    failures) or Tradovate explicitly asked us to come back (503 + Retry-After).
+    """
+    if isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return ORDER_RETRY_BACKOFF_S
+    if isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code == 503:
+        try:
+            retry_after = float(exc.response.headers.get("Retry-After", ""))
+        except ValueError:
+            return None  # missing or HTTP-date form; don't guess
+        if not math.isfinite(retry_after) or retry_after < 0:
+            return None  # "nan"/"inf"/negative would make time.sleep raise
+        return max(0.0, min(retry_after, ORDER_RETRY_AFTER_MAX_S))
+    return None
+
 class TradovateClient:
     def __init__(self):
-        self.session = requests.Session()
+        self.session = self._build_session()
         self._token: Optional[str] = None
         self._token_expiry: float = 0.0
         self._account_id: Optional[int] = int(TDV_ACCOUNT_ID) if TDV_ACCOUNT_ID else None
-        self._contract_cache: Dict[str, int] = {}   # "ESZ5" or "ES->resolved_id"
+        # "ESZ5" or "ES->active_id" → contractId; guarded by _cache_lock (TTLCache is not thread-safe)
+        self._contract_cache: TTLCache = TTLCache(maxsize=CONTRACT_CACHE_SIZE, ttl=CONTRACT_CACHE_TTL_S)
         self._root_to_active: Dict[str, Dict[str, Any]] = {}  # cache of root → active contract JSON
-        self._lock = threading.Lock()
+        self._lock = threading.Lock()         # token/auth state
+        self._cache_lock = threading.Lock()   # contract cache only, so lookups never wait on an auth RTT
+        self._refresher_started = False
+        self._preseed_thread: Optional[threading.Thread] = None
+        self._close_pool = ThreadPoolExecutor(max_workers=FLATTEN_MAX_PARALLEL, thread_name_prefix="tdv-close")
+
+    @staticmethod
+    def _build_session() -> httpx.Client:
+        """HTTP/2 keep-alive client: auth, lookups and orders multiplex over one TLS connection."""
+        limits = httpx.Limits(max_keepalive_connections=20, max_connections=50)
+        # retries covers connect failures only; HTTP status codes surface via raise_for_status
+        transport = httpx.HTTPTransport(http2=True, limits=limits, retries=2, socket_options=HTTP_SOCKET_OPTIONS)
+        return httpx.Client(timeout=HTTP_TIMEOUT, transport=transport)
 
     def _auth_payload(self) -> Dict[str, Any]:
         if not (TDV_USERNAME and TDV_PASSWORD and TDV_SEC):
@@ -82,36 +170,100 @@ class TradovateClient:
             "sec": TDV_SEC
         }
 
+    def _request_token(self):
+        """POST the auth request and swap in the new token. Caller must hold _lock."""
+        now = time.time()
+        url = f"{TDV_HOST}/v1/auth/accesstokenrequest"
+        r = self.session.post(url, json=self._auth_payload(), timeout=HTTP_TIMEOUT)
+        r.raise_for_status()
+        data = _json(r)
+        token = data.get("accessToken")
+        if not token:
+            raise RuntimeError("Tradovate auth returned no accessToken.")
+        # Resolve the account before publishing anything: if this fails, the token
+        # must not look valid or orders would go out with accountId=None.
+        if not self._account_id:
+            self._account_id = self._fetch_account_id(token)
+        # Swap happens under _lock as one dict update plus plain attribute stores,
+        # token last; concurrent requests send either the old or the new token.
+        # auth rides on the session, so per-call code never rebuilds headers
+        self.session.headers.update({
+            "Authorization": f"Bearer {token}",
+            "Accept": "application/json",
+            "Content-Type": "application/json"
+        })
+        # Tradovate reports when the token lapses (typically ~90 min out); the refresh
+        # loop and the inline check key off this, so honour it. Fallback ~23h.
+        self._token_expiry = _utc_ts(data.get("expirationTime")) or (now + 23 * 3600)
+        self._token = token
+        # warm the contract cache off the request path
+        self._preseed_thread = threading.Thread(target=self._preseed_contracts, daemon=True)
+        self._preseed_thread.start()
+
+    def _token_valid(self) -> bool:
+        return bool(self._token) and time.time() < (self._token_expiry - 60)
+
     def ensure_token(self):
+        # Safety net: the refresh thread normally keeps the token hot, but a
+        # cold start or a failed background refresh still authenticates inline.
+        if self._token_valid():
+            return  # lock-free fast path
         with self._lock:
-            now = time.time()
-            if self._token and now < (self._token_expiry - 60):
+            # Re-check under the lock: a cold burst queues here behind the one
+            # thread doing the auth POST, then returns on its fresh token.
+            if self._token_valid():
                 return
-            url = f"{TDV_HOST}/v1/auth/accesstokenrequest"
-            r = self.session.post(url, json=self._auth_payload(), timeout=HTTP_TIMEOUT_S)
-            r.raise_for_status()
-            data = r.json()
-            self._token = data.get("accessToken")
-            # fallback validity window ~23h
-            self._token_expiry = now + 23 * 3600
-            if not self._token:
-                raise RuntimeError("Tradovate auth returned no accessToken.")
-            if not self._account_id:
-                self._account_id = self._fetch_account_id()
-
-    def _headers(self) -> Dict[str, str]:
-        self.ensure_token()
-        return {
-            "Authorization": f"Bearer {self._token}",
-            "Accept": "application/json",
-            "Content-Type": "application/json"
-        }
+            self._request_token()
+            if not self._refresher_started:
+                self._refresher_started = True
+                threading.Thread(target=self._refresh_loop, daemon=True).start()
+
+    def warm_up(self, budget: float = 15.0) -> Optional[str]:
+        """Authenticate and wait for the contract preseed, returning within `budget` seconds.
+
+        Called from gunicorn post_fork, which runs before the worker's first heartbeat, so
+        the whole warm-up must stay under gunicorn's timeout. Auth runs on a daemon thread;
+        if it overruns, it keeps going and the first webhook waits on it behind _lock.
+        Returns None once the token is ready, else why it isn't.
+        """
+        deadline = time.monotonic() + budget
+        errors: List[Exception] = []
+
+        def _auth():
+            try:
+                self.ensure_token()
+            except Exception as e:
+                errors.append(e)   # reported by the caller, not threading.excepthook
+
+        auth = threading.Thread(target=_auth, daemon=True, name="tdv-warmup")
+        auth.start()
+        auth.join(budget)
+        if errors:
+            return f"auth failed: {errors[0]}"
+        if auth.is_alive():
+            return f"auth still running after {budget:.0f}s"
+        t = self._preseed_thread
+        if t is not None:
+            t.join(max(0.0, deadline - time.monotonic()))
+        return None
+
+    def _refresh_loop(self):
+        """Renew the token ahead of expiry so webhooks never pay the auth RTT."""
+        while True:
+            time.sleep(max(1, self._token_expiry - time.time() - TOKEN_REFRESH_LEAD_S))
+            try:
+                with self._lock:
+                    self._request_token()
+            except Exception:
+                # leave the current token in place; ensure_token covers us if it lapses
+                time.sleep(TOKEN_REFRESH_RETRY_S)
 
-    def _fetch_account_id(self) -> int:
+    def _fetch_account_id(self, token: str) -> int:
+        # called from _request_token with _lock held, before the token is published
         url = f"{TDV_HOST}/v1/account/list"
-        r = self.session.get(url, headers=self._headers(), timeout=HTTP_TIMEOUT_S)
+        r = self.session.get(url, headers={"Authorization": f"Bearer {token}"}, timeout=HTTP_TIMEOUT)
         r.raise_for_status()
-        accounts = r.json()
+        accounts = _json(r)
         if not isinstance(accounts, list) or not accounts:
             raise RuntimeError("No Tradovate accounts available.")
         return int(accounts[0]["id"])
@@ -120,62 +272,82 @@ class TradovateClient:
     @staticmethod
     def _is_explicit_month(symbol: str) -> bool:
         # crude: explicit month codes include a digit (e.g., ESZ5, 6EZ5)
-        return any(ch.isdigit() for ch in symbol)
+        return _HAS_DIGIT(symbol) is not None
 
     def _pick_front_month(self, contracts: List[Dict[str, Any]]) -> Dict[str, Any]:
         """Choose nearest non-expired contract (by expiration)."""
-        now = datetime.datetime.utcnow()
+        now = time.time()
         best = None
         best_exp = None
         for c in contracts:
             exp_raw = c.get("expiration") or c.get("expirationDate") or c.get("expirationTime")
             if not exp_raw:
                 continue
-            try:
-                exp = datetime.datetime.fromisoformat(exp_raw.replace("Z", "+00:00"))
-            except Exception:
+            exp = _utc_ts(exp_raw)   # compare floats, not datetimes
+            if exp is None:
                 continue
             if exp > now and (best_exp is None or exp < best_exp):
                 best, best_exp = c, exp
         # if none in future, fall back to first
         return best or (contracts[0] if contracts else None)
 
+    def _cached_contract(self, key: str) -> Optional[int]:
+        with self._cache_lock:
+            return self._contract_cache.get(key)
+
+    def _store_contract(self, key: str, cid: int):
+        with self._cache_lock:
+            self._contract_cache[key] = cid
+
+    def _preseed_contracts(self):
+        """Resolve every root we have a risk cap for, so first orders skip /contract/find."""
+        for root in MAX_QTY_PER_ROOT:
+            try:
+                self.resolve_contract_id(root)
+            except Exception:
+                # not every root is listed on every account/environment
+                continue
+
     def resolve_contract_id(self, instrument: str) -> int:
         """Accepts ES or ESZ5, 6E or 6EZ5, etc."""
         key = instrument.strip().upper()
 
         # If explicit month ("ESZ5"), we can find directly.
         if self._is_explicit_month(key):
-            if key in self._contract_cache:
-                return self._contract_cache[key]
+            cached = self._cached_contract(key)
+            if cached is not None:
+                return cached
+            self.ensure_token()
             url = f"{TDV_HOST}/v1/contract/find"
-            r = self.session.get(url, headers=self._headers(), params={"name": key}, timeout=HTTP_TIMEOUT_S)
+            r = self.session.get(url, params={"name": key}, timeout=HTTP_TIMEOUT)
             r.raise_for_status()
-            data = r.json()
+            data = _json(r)
             if isinstance(data, dict) and data.get("id"):
                 cid = int(data["id"])
             elif isinstance(data, list) and data:
                 cid = int(data[0]["id"])
             else:
                 raise RuntimeError(f"Could not resolve contractId for '{key}'.")
-            self._contract_cache[key] = cid
+            self._store_contract(key, cid)
             return cid
 
         # Root-only ("ES", "MES", "6E", "MGC") → pull all matches, pick front month
         root = key
         cache_key = f"{root}->active_id"
-        if cache_key in self._contract_cache:
-            return self._contract_cache[cache_key]
+        cached = self._cached_contract(cache_key)
+        if cached is not None:
+            return cached
 
+        self.ensure_token()
         url = f"{TDV_HOST}/v1/contract/find"
-        r = self.session.get(url, headers=self._headers(), params={"name": root}, timeout=HTTP_TIMEOUT_S)
+        r = self.session.get(url, params={"name": root}, timeout=HTTP_TIMEOUT)
         r.raise_for_status()
-        data = r.json()
+        data = _json(r)
         contracts: List[Dict[str, Any]] = []
         if isinstance(data, dict) and data.get("id"):
             contracts = [data]
         elif isinstance(data, list):
-            # filter by root match at the beginning of name
+            # filter by root match at the beginning of name (root is already upper-case)
             contracts = [c for c in data if str(c.get("name", "")).upper().startswith(root)]
         if not contracts:
             raise RuntimeError(f"No contracts found for root '{root}'.")
@@ -185,7 +357,7 @@ class TradovateClient:
             raise RuntimeError(f"Could not determine front-month for '{root}'.")
         cid = int(chosen["id"])
         self._root_to_active[root] = chosen
-        self._contract_cache[cache_key] = cid
+        self._store_contract(cache_key, cid)
         return cid
 
     # ── Orders ────────────────────────────────────────────────
@@ -201,16 +373,31 @@ class TradovateClient:
             "timeInForce": "Day",
             "isAutomated": True
         }
+        return self._place_order(body)
+
+    def _place_order(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        # Retries live here, per POST, so a flatten only re-sends the leg that failed.
         url = f"{TDV_HOST}/v1/order/place"
-        r = self.session.post(url, headers=self._headers(), json=body, timeout=HTTP_TIMEOUT_S)
-        r.raise_for_status()
-        return r.json()
+        for attempt in range(1, ORDER_MAX_ATTEMPTS + 1):
+            try:
+                self.ensure_token()
+                r = self.session.post(url, json=body, timeout=HTTP_TIMEOUT)
+                r.raise_for_status()
+                return _json(r)
+            except Exception as e:
+                delay = _retry_delay(e)
+                if delay is None or attempt == ORDER_MAX_ATTEMPTS:
+                    raise
+                app.logger.warning("order/place contract %s attempt %d not sent (%s); retrying in %.1fs",
+                                   body.get("contractId"), attempt, e, delay)
+                time.sleep(delay)
 
     def positions(self) -> List[Dict[str, Any]]:
+        self.ensure_token()
         url = f"{TDV_HOST}/v1/position/list"
-        r = self.session.get(url, headers=self._headers(), timeout=HTTP_TIMEOUT_S)
+        r = self.session.get(url, timeout=HTTP_TIMEOUT)
         r.raise_for_status()
-        data = r.json()
+        data = _json(r)
         return data if isinstance(data, list) else []
 
     def flatten_side(self, side: str, instrument: Optional[str] = None) -> Dict[str, Any]:
@@ -220,7 +407,7 @@ class TradovateClient:
             target_cid = self.resolve_contract_id(instrument)
 
         pos = self.positions()
-        results = []
+        bodies = []
         for p in pos:
             if target_cid and int(p.get("contractId")) != target_cid:
                 continue
@@ -233,7 +420,7 @@ class TradovateClient:
                 qty = abs(net)
             else:
                 continue
-            body = {
+            bodies.append({
                 "accountId": self._account_id,
                 "contractId": int(p["contractId"]),
                 "action": action,
@@ -241,11 +428,23 @@ class TradovateClient:
                 "orderQty": qty,
                 "timeInForce": "Day",
                 "isAutomated": True
-            }
-            url = f"{TDV_HOST}/v1/order/place"
-            rr = self.session.post(url, headers=self._headers(), json=body, timeout=HTTP_TIMEOUT_S)
-            rr.raise_for_status()
-            results.append(rr.json())
+            })
+        # Tradovate has no batch endpoint for independent market orders (placeOSO is a
+        # bracket), so fan the closes out over the shared HTTP/2 connection: ~1 RTT instead of N.
+        futures = [self._close_pool.submit(self._place_order, b) for b in bodies]
+        results: List[Dict[str, Any]] = []
+        failed: List[Dict[str, Any]] = []
+        for body, fut in zip(bodies, futures):
+            try:
+                results.append(fut.result())
+                app.logger.info("flatten %s: closed contract %s (%s %s)",
+                                side, body["contractId"], body["action"], body["orderQty"])
+            except Exception as e:
+                failed.append({"contractId": body["contractId"], "error": str(e)})
+                app.logger.error("flatten %s: close of contract %s failed: %s", side, body["contractId"], e)
+        if failed:
+            # raise only once every leg is accounted for (and logged) above
+            raise RuntimeError(f"flatten {side}: {len(failed)} of {len(bodies)} closes failed: {failed}")
         return {"closed": results, "count": len(results)}
 
 client = TradovateClient()
@@ -253,34 +452,121 @@ client = TradovateClient()
 # ─────────────────────────────────────────────────────────────
 # Risk checks
 # ─────────────────────────────────────────────────────────────
+_ROOT_RE = re.compile(r"^[A-Z]+")
+
+# MAX_QTY_PER_ROOT normalised once, so hand-edited lower-case keys still match
+_ROOT_CAPS: Dict[str, int] = {k.upper(): v for k, v in MAX_QTY_PER_ROOT.items()}
+
+@functools.lru_cache(maxsize=256)
 def root_from_instrument(instr: str) -> str:
     s = instr.upper()
     # strip month code if present → take leading alpha block
-    i = 0
-    while i < len(s) and s[i].isalpha():
-        i += 1
-    return s[:i] if i > 0 else s
+    m = _ROOT_RE.match(s)
+    return m.group(0) if m else s
 
 def enforce_risk(instrument: str, qty: int):
     if qty <= 0:
         raise ValueError("Quantity must be > 0")
 
     root = root_from_instrument(instrument)
-    max_allowed = MAX_QTY_PER_ROOT.get(root)
+    max_allowed = _ROOT_CAPS.get(root)
     if max_allowed is not None and qty > max_allowed:
         raise ValueError(f"Risk guard: {root} max qty {max_allowed}, requested {qty}.")
 
-    # crude notional cap guard (prevents huge orders on minis)
-    # get a price via md endpoint if available; otherwise skip this check
+    # Notional cap (MAX_NOTIONAL_PER_ORDER) is not enforced yet: a true quote API
+    # requires a market-data token. Plug a pricing source here when available;
+    # place_market resolves (and caches) the contractId, so don't resolve it again.
+
+# ─────────────────────────────────────────────────────────────
+# Order queue
+# ─────────────────────────────────────────────────────────────
+# One thread drains the queue in arrival order. The queue and dedupe state are
+# per process, so ordering and dedupe only hold with a single gunicorn worker
+# (gunicorn.conf.py pins workers = 1); move both to shared state before scaling out.
+_ORDER_Q: "queue.Queue[Tuple[str, Callable[..., Dict[str, Any]], tuple]]" = queue.Queue(maxsize=ORDER_QUEUE_SIZE)
+_seen_ids: TTLCache = TTLCache(maxsize=4096, ttl=WEBHOOK_DEDUPE_S)
+_seen_bodies: Optional[TTLCache] = (
+    TTLCache(maxsize=4096, ttl=WEBHOOK_BODY_DEDUPE_S) if WEBHOOK_BODY_DEDUPE_S > 0 else None
+)
+_seen_lock = threading.Lock()
+
+def _dedupe_slot(payload: Dict[str, Any], raw: bytes) -> Optional[Tuple[TTLCache, str]]:
+    """Cache + key to dedupe this alert on, or None when a repeat may be a real new signal."""
+    if payload.get("id"):
+        # a retry resends the body verbatim; a reversal under the same id does not
+        return _seen_ids, f"{payload['id']}:{hashlib.sha1(raw).hexdigest()}"
+    if _seen_bodies is not None:
+        return _seen_bodies, hashlib.sha1(raw).hexdigest()
+    return None
+
+def _enqueue(ref: str, dedupe: Optional[Tuple[TTLCache, str]],
+             fn: Callable[..., Dict[str, Any]], *args) -> Optional[str]:
+    """Queue an order call; returns an error string if it was a duplicate or the queue is full."""
+    if dedupe is not None:
+        seen, key = dedupe
+        with _seen_lock:
+            if key in seen:
+                return "duplicate"
+            seen[key] = True
     try:
-        # Attempt to fetch a recent quote for estimate (md token not required for REST here, but may 401 on some setups)
-        # If this errors, we silently ignore and rely on MAX_QTY_PER_ROOT.
-        cid = client.resolve_contract_id(instrument)
-        # MV: a true quote API requires market-data token; as a conservative fallback we skip.
-        # You can plug a pricing source here to compute notional and enforce MAX_NOTIONAL_PER_ORDER.
-        _ = cid
+        _ORDER_Q.put_nowait((ref, fn, args))
+    except queue.Full:
+        if dedupe is not None:
+            with _seen_lock:
+                seen.pop(key, None)  # let TradingView's retry through
+        return "order queue full"
+    return None
+
+def _run_order(ref: str, fn: Callable[..., Dict[str, Any]], args: tuple):
+    # Runs exactly once: place_market/flatten_side retry individual POSTs in
+    # _place_order, and re-running a whole flatten would re-send legs already filled.
+    try:
+        resp = fn(*args)
+        app.logger.info("order %s ok: %s", ref, resp)
+    except httpx.HTTPStatusError as e:
+        app.logger.error("order %s failed: HTTP %s %s", ref, e.response.status_code, e.response.text)
     except Exception:
-        pass
+        app.logger.exception("order %s failed", ref)
+
+def _order_worker():
+    # This is the only thread that places queued orders: nothing may escape the loop,
+    # or every later webhook would get a 202 for an order that is never sent.
+    while True:
+        ref, fn, args = _ORDER_Q.get()
+        try:
+            _run_order(ref, fn, args)
+        except Exception:
+            app.logger.exception("order %s: worker error", ref)
+        finally:
+            _ORDER_Q.task_done()
+
+threading.Thread(target=_order_worker, daemon=True, name="tdv-orders").start()
+
+def drain_orders(timeout: float) -> int:
+    """Wait up to `timeout`s for queued + in-flight orders. Called from gunicorn worker_exit.
+
+    Orders already answered 202 exist only in this process; TradingView won't resend
+    them, so log anything still pending. Returns how many were left unfinished.
+    """
+    deadline = time.monotonic() + timeout
+    with _ORDER_Q.all_tasks_done:
+        while _ORDER_Q.unfinished_tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            _ORDER_Q.all_tasks_done.wait(remaining)
+        left = _ORDER_Q.unfinished_tasks
+    if left:
+        abandoned = []
+        while True:
+            try:
+                ref, fn, args = _ORDER_Q.get_nowait()
+            except queue.Empty:
+                break
+            abandoned.append(f"{ref} {fn.__name__}{args}")
+        app.logger.error("shutdown: %d order(s) unfinished after %.0fs (%d in flight); abandoned: %s",
+                         left, timeout, left - len(abandoned), abandoned)
+    return left
 
 # ─────────────────────────────────────────────────────────────
 # Routes
@@ -288,7 +574,7 @@ def enforce_risk(instrument: str, qty: int):
 @app.get("/")
 def health():
     roots = sorted(set(MAX_QTY_PER_ROOT.keys()))
-    return jsonify({
+    return _jsonify({
         "ok": True,
         "service": "TGIM Tradovate Bridge",
         "host": TDV_HOST,
@@ -300,48 +586,71 @@ def health():
         "roots_supported": roots[:50]  # preview
     })
 
+# TradingView already sends strings/ints; only coerce when it doesn't
+def _norm_str(x: Any) -> str:
+    return x.strip().upper() if isinstance(x, str) else str(x).strip().upper()
+
+def _norm_key(x: Any) -> str:
+    return x.strip().lower() if isinstance(x, str) else str(x).strip().lower()
+
+def _norm_qty(x: Any) -> int:
+    if isinstance(x, bool):
+        raise ValueError("units must be a number")   # int(True) would be a silent 1-lot
+    return x if type(x) is int else int(float(x))
+
 @app.post("/webhook")
 def webhook():
-    # Optional shared secret
-    if TV_SHARED_SECRET:
-        if request.headers.get("X-TV-Secret") != TV_SHARED_SECRET and request.args.get("secret") != TV_SHARED_SECRET:
-            return jsonify({"ok": False, "error": "unauthorized"}), 401
-
+    # Optional shared secret (constant-time compare)
+    if _SECRET_BYTES:
+        h = request.headers.get("X-TV-Secret", "").encode()
+        q = request.args.get("secret", "").encode()
+        if not (hmac.compare_digest(h, _SECRET_BYTES) or hmac.compare_digest(q, _SECRET_BYTES)):
+            return _jsonify({"ok": False, "error": "unauthorized"}), 401
+
+    raw = request.get_data(cache=False)
     try:
-        payload = request.get_json(force=True, silent=False)
-    except Exception:
-        return jsonify({"ok": False, "error": "invalid JSON"}), 400
-
-    action = str(payload.get("action", "")).lower()
+        payload = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return _jsonify({"ok": False, "error": "invalid JSON"}), 400
+    if not isinstance(payload, dict):
+        return _jsonify({"ok": False, "error": "invalid JSON"}), 400
+
+    action = _norm_key(payload.get("action", ""))
+    dedupe = _dedupe_slot(payload, raw)
+    ref = dedupe[1] if dedupe else uuid.uuid4().hex   # echoed back and used in order logs
     try:
         if action in ("buy", "sell"):
-            instrument = str(payload.get("instrument", "")).strip().upper()
+            instrument = _norm_str(payload.get("instrument", ""))
             if not instrument:
-                return jsonify({"ok": False, "error": "instrument required"}), 400
-            qty = int(float(payload.get("units", 1)))
+                return _jsonify({"ok": False, "error": "instrument required"}), 400
+            qty = _norm_qty(payload.get("units", 1))
             enforce_risk(instrument, qty)
-            resp = client.place_market(instrument, qty, action)
-            return jsonify({"ok": True, "type": "entry", "action": action, "instrument": instrument, "qty": qty, "resp": resp})
+            err = _enqueue(ref, dedupe, client.place_market, instrument, qty, action)
+            if err == "duplicate":
+                return _jsonify({"ok": True, "duplicate": True, "id": ref})
+            if err:
+                return _jsonify({"ok": False, "error": err}), 503
+            return _jsonify({"ok": True, "queued": True, "id": ref, "type": "entry", "action": action, "instrument": instrument, "qty": qty}), 202
 
         if action == "close":
-            side = str(payload.get("side", "")).lower()
+            side = _norm_key(payload.get("side", ""))
             if side not in ("long", "short"):
-                return jsonify({"ok": False, "error": "close requires side=long|short"}), 400
+                return _jsonify({"ok": False, "error": "close requires side=long|short"}), 400
             instrument = payload.get("instrument")
-            instrument = str(instrument).upper().strip() if instrument else None
-            resp = client.flatten_side(side, instrument)
-            return jsonify({"ok": True, "type": "close", "side": side, "instrument": instrument, "resp": resp})
+            instrument = _norm_str(instrument) if instrument else None
+            err = _enqueue(ref, dedupe, client.flatten_side, side, instrument)
+            if err == "duplicate":
+                return _jsonify({"ok": True, "duplicate": True, "id": ref})
+            if err:
+                return _jsonify({"ok": False, "error": err}), 503
+            return _jsonify({"ok": True, "queued": True, "id": ref, "type": "close", "side": side, "instrument": instrument}), 202
 
-        return jsonify({"ok": False, "error": f"unknown action '{action}'"}), 400
+        return _jsonify({"ok": False, "error": f"unknown action '{action}'"}), 400
 
-    except requests.HTTPError as he:
-        try:
-            return jsonify({"ok": False, "http": he.response.status_code, "body": he.response.json()}), 502
-        except Exception:
-            return jsonify({"ok": False, "http": 502, "body": str(he)}), 502
     except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 400
+        return _jsonify({"ok": False, "error": str(e)}), 400
 
-# Entrypoint (Render uses Procfile → gunicorn app:app)
+# Entrypoint (Render uses Procfile → gunicorn -c gunicorn.conf.py app:app, threaded workers;
+# TradovateClient is shared across threads; token state sits behind _lock, the contract cache behind _cache_lock)
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", "8000")))
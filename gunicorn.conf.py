@@ -0,0 +1,34 @@
+import os
+
+# ─────────────────────────────────────────────────────────────
+# Gunicorn (Procfile → gunicorn -c gunicorn.conf.py app:app)
+# ─────────────────────────────────────────────────────────────
+bind         = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = "gthread"
+# Pinned to one process: the order queue, its worker thread and alert dedupe live
+# in-process (app.py), so a second worker could run a close and the next buy out
+# of order and would not see the first worker's dedupe keys. Scale with threads.
+workers      = 1
+threads      = int(os.getenv("GUNICORN_THREADS", "8"))
+# post_fork runs before the first heartbeat; warm_up's budget must stay well under this
+timeout      = 30
+WARMUP_BUDGET_S = 15
+# on SIGTERM (Render redeploy) the arbiter SIGKILLs after graceful_timeout; worker_exit
+# drains the in-process order queue inside that window
+graceful_timeout = 30
+ORDER_DRAIN_S    = 20
+
+def post_fork(server, worker):
+    # Warm each fresh worker (TLS + auth + contract cache) before it takes webhooks
+    from app import client
+    # don't block boot on Tradovate; the first webhook will authenticate inline
+    err = client.warm_up(WARMUP_BUDGET_S)
+    if err:
+        worker.log.warning("Tradovate warm-up incomplete (%s); continuing cold", err)
+
+def worker_exit(server, worker):
+    # 202'd orders live only in this process's queue; finish them before exiting
+    from app import drain_orders
+    left = drain_orders(ORDER_DRAIN_S)
+    if left:
+        worker.log.error("exiting with %d unfinished order(s); see app log for details", left)